@@ -8,6 +8,7 @@ import tensorflow as tf
 from model.input_fn import test_input_fn
 from model.model_fn import model_fn
 from model.utils import Params
+from model.utils import get_session_config
 
 
 parser = argparse.ArgumentParser()
@@ -29,7 +30,8 @@ if __name__ == '__main__':
 
     # Define the model
     tf.logging.info("Creating the model...")
-    estimator = tf.estimator.Estimator(model_fn, params=params, model_dir=args.model_dir)
+    config = tf.estimator.RunConfig(model_dir=args.model_dir, session_config=get_session_config())
+    estimator = tf.estimator.Estimator(model_fn, params=params, config=config)
 
     # Evaluate the model on the test set
     tf.logging.info("Evaluation on the test set.")
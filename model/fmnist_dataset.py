@@ -1,44 +1,127 @@
+import concurrent.futures
+import contextlib
+import functools
 import gzip
+import io
+import mmap
 import os
 import shutil
+import struct
 
 import numpy as np
 from six.moves import urllib
 import tensorflow as tf
 
+# Size of the buffers used to download and decompress files
+COPY_BUFFER_SIZE = 1 << 20
 
-def read32(bytestream):
-    """Read 4 bytes from bytestream as an unsigned 32-bit integer."""
-    dt = np.dtype(np.uint32).newbyteorder('>')
-    return np.frombuffer(bytestream.read(4), dtype=dt)[0]
+# Number of TFRecord files the training set is split into
+NUM_SHARDS = 8
+
+# Number of TFRecord examples parsed together by a single map call
+PARSE_BATCH_SIZE = 1024
 
 
 def check_image_file_header(filename):
     """Validate that filename corresponds to images for the FMNIST dataset."""
+    error = _image_file_header_error(filename, tf.gfile.Stat(filename).mtime_nsec)
+    if error:
+        raise ValueError(error)
+
+
+def check_labels_file_header(filename):
+    """Validate that filename corresponds to labels for the FMNIST dataset."""
+    error = _labels_file_header_error(filename, tf.gfile.Stat(filename).mtime_nsec)
+    if error:
+        raise ValueError(error)
+
+
+# The header checks run every time an input function is called, so their results are cached
+# by filename and modification time. They return an error message (or None if the header is
+# valid) instead of raising, so that failures are cached too.
+
+@functools.lru_cache(maxsize=16)
+def _image_file_header_error(filename, mtime):
     with tf.gfile.Open(filename, 'rb') as f:
-        magic = read32(f)
-        read32(f)  # num_images, unused
-        rows = read32(f)
-        cols = read32(f)
+        # magic, num_images (unused), rows, cols as big-endian unsigned 32-bit integers
+        magic, _, rows, cols = struct.unpack('>IIII', f.read(16))
         if magic != 2051:
-            raise ValueError('Invalid magic number %d in FMNIST file %s' % (magic, f.name))
+            return 'Invalid magic number %d in FMNIST file %s' % (magic, f.name)
         if rows != 28 or cols != 28:
-            raise ValueError(
-                    'Invalid FMNIST file %s: Expected 28x28 images, found %dx%d' %
+            return ('Invalid FMNIST file %s: Expected 28x28 images, found %dx%d' %
                     (f.name, rows, cols))
+    return None
 
 
-def check_labels_file_header(filename):
-    """Validate that filename corresponds to labels for the FMNIST dataset."""
+@functools.lru_cache(maxsize=16)
+def _labels_file_header_error(filename, mtime):
     with tf.gfile.Open(filename, 'rb') as f:
-        magic = read32(f)
-        read32(f)  # num_items, unused
+        # magic, num_items (unused) as big-endian unsigned 32-bit integers
+        magic, _ = struct.unpack('>II', f.read(8))
         if magic != 2049:
-            raise ValueError('Invalid magic number %d in FMNIST file %s' % (magic, f.name))
+            return 'Invalid magic number %d in FMNIST file %s' % (magic, f.name)
+    return None
+
+
+def download_ranges(url, filepath, num_threads):
+    """Download url to filepath with `num_threads` parallel HTTP range requests.
+
+    Returns False without downloading anything if the server does not support range requests.
+    """
+    request = urllib.request.Request(url, method='HEAD')
+    try:
+        with contextlib.closing(urllib.request.urlopen(request)) as response:
+            length = int(response.headers.get('Content-Length', 0))
+            accept_ranges = response.headers.get('Accept-Ranges', 'none')
+    except urllib.error.HTTPError:
+        # Some servers and proxies reject HEAD requests
+        return False
+    if length == 0 or accept_ranges != 'bytes':
+        return False
+
+    range_size = -(-length // num_threads)  # ceil division
+
+    # Download to a temporary file so that a failed download does not leave a partial file behind
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'w+b') as f:
+        f.truncate(length)
+        buffer = mmap.mmap(f.fileno(), length)
+
+        def fetch(start):
+            end = min(start + range_size, length)
+            headers = {'Range': 'bytes=%d-%d' % (start, end - 1)}
+            request = urllib.request.Request(url, headers=headers)
+            with contextlib.closing(urllib.request.urlopen(request)) as response:
+                if response.getcode() != 206:
+                    raise IOError('Server ignored range request for %s' % url)
+                while start < end:
+                    data = response.read(min(COPY_BUFFER_SIZE, end - start))
+                    if not data:
+                        raise IOError('Incomplete download of %s' % url)
+                    buffer[start:start + len(data)] = data
+                    start += len(data)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+                # list() re-raises the first exception of the threads
+                list(executor.map(fetch, range(0, length, range_size)))
+            buffer.flush()
+        except BaseException:
+            buffer.close()
+            f.close()
+            os.remove(tmp_filepath)
+            raise
+        buffer.close()
+    os.rename(tmp_filepath, filepath)
+    return True
 
 
 def download(directory, filename):
-    """Download (and unzip) a file from the FMNIST dataset if not already done."""
+    """Download (and unzip) a file from the FMNIST dataset if not already done.
+
+    Set the FMNIST_DOWNLOAD_THREADS environment variable to download with several parallel
+    connections.
+    """
     filepath = os.path.join(directory, filename)
     if tf.gfile.Exists(filepath):
         return filepath
@@ -47,44 +130,135 @@ def download(directory, filename):
 
     url = "http://fashion-mnist.s3-website.eu-central-1.amazonaws.com/" + filename + ".gz"
 
+    # Decompress into a temporary file so that an interrupted download is not mistaken for the
+    # dataset
+    tmp_filepath = filepath + '.tmp'
     zipped_filepath = filepath + '.gz'
-    print('Downloading %s to %s' % (url, zipped_filepath))
-    urllib.request.urlretrieve(url, zipped_filepath)
-    with gzip.open(zipped_filepath, 'rb') as f_in, open(filepath, 'wb') as f_out:
-        shutil.copyfileobj(f_in, f_out)
-    os.remove(zipped_filepath)
+    num_threads = int(os.environ.get('FMNIST_DOWNLOAD_THREADS', 1))
+    print('Downloading %s to %s' % (url, filepath))
+
+    if num_threads > 1 and download_ranges(url, zipped_filepath, num_threads):
+        with gzip.open(zipped_filepath, 'rb') as f_in, open(tmp_filepath, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, COPY_BUFFER_SIZE)
+        os.remove(zipped_filepath)
+    else:
+        # Decompress the response while it is downloaded
+        with contextlib.closing(urllib.request.urlopen(url)) as response:
+            # Buffer the compressed stream so that gzip does not issue a socket read per small chunk
+            compressed = io.BufferedReader(response, buffer_size=COPY_BUFFER_SIZE)
+            with gzip.GzipFile(fileobj=compressed) as f_in, open(tmp_filepath, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out, COPY_BUFFER_SIZE)
+    os.rename(tmp_filepath, filepath)
     return filepath
 
 
-def dataset(directory, images_file, labels_file):
-    """Download and parse FMNIST dataset."""
+def prepare(directory, images_file, labels_file):
+    """Download the FMNIST images and labels files and validate their headers."""
 
     images_file = download(directory, images_file)
     labels_file = download(directory, labels_file)
 
     check_image_file_header(images_file)
     check_labels_file_header(labels_file)
+    return images_file, labels_file
+
+
+def load(directory, images_file, labels_file):
+    """Download FMNIST and decode it into uint8 numpy arrays of images and labels."""
+
+    images_file, labels_file = prepare(directory, images_file, labels_file)
+
+    # FMNIST is small enough to be read and decoded in one go
+    with tf.gfile.Open(images_file, 'rb') as f:
+        images = np.frombuffer(f.read(), dtype=np.uint8, offset=16).reshape(-1, 784)
+    with tf.gfile.Open(labels_file, 'rb') as f:
+        labels = np.frombuffer(f.read(), dtype=np.uint8, offset=8)
+    return images, labels
+
+
+def dataset(directory, images_file, labels_file):
+    """Download and parse FMNIST dataset."""
+
+    images_file, labels_file = prepare(directory, images_file, labels_file)
+
+    # Each file is read and decoded in one go when the graph runs, the decoded tensors are then
+    # cached in memory so that later epochs do not read the files again. Building the dataset
+    # from numpy arrays instead would embed the whole dataset as constants in the saved graphs.
+    def decode_images(filename):
+        images = tf.decode_raw(tf.read_file(filename), tf.uint8)[16:]
+        return tf.reshape(images, [-1, 784])
+
+    def decode_labels(filename):
+        return tf.decode_raw(tf.read_file(filename), tf.uint8)[8:]
+
+    images = tf.data.Dataset.from_tensors(images_file).map(decode_images)
+    labels = tf.data.Dataset.from_tensors(labels_file).map(decode_labels)
+
+    # Images and labels are kept as uint8, they are only converted inside the model
+    dataset = tf.data.Dataset.zip((images, labels)).cache()
+    return dataset.apply(tf.data.experimental.unbatch())
+
+
+def shard_filenames(directory, prefix, num_shards=NUM_SHARDS):
+    """Return the paths of the TFRecord shards of FMNIST split `prefix`."""
+    return [os.path.join(directory, '%s-%05d-of-%05d.tfrecord' % (prefix, i, num_shards))
+            for i in range(num_shards)]
+
+
+def write_shards(directory, images_file, labels_file, prefix, num_shards=NUM_SHARDS):
+    """Convert FMNIST into `num_shards` TFRecord files of `tf.train.Example`."""
+    images, labels = load(directory, images_file, labels_file)
+
+    for i, filename in enumerate(shard_filenames(directory, prefix, num_shards)):
+        print('Writing %s' % filename)
+        # Write to a temporary file so that an interrupted conversion is not mistaken for a shard
+        with tf.python_io.TFRecordWriter(filename + '.tmp') as writer:
+            for image, label in zip(images[i::num_shards], labels[i::num_shards]):
+                feature = {
+                    'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.tobytes()])),
+                    'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[int(label)]))}
+                example = tf.train.Example(features=tf.train.Features(feature=feature))
+                writer.write(example.SerializeToString())
+        tf.gfile.Rename(filename + '.tmp', filename, overwrite=True)
+
+
+def sharded_dataset(directory, images_file, labels_file, prefix, num_shards=NUM_SHARDS):
+    """Read FMNIST from TFRecord shards, converting it first if needed.
+
+    The shards are read in parallel, which mostly pays off when `directory` lives on a
+    networked filesystem.
+    """
+    filenames = shard_filenames(directory, prefix, num_shards)
+    if not all(tf.gfile.Exists(filename) for filename in filenames):
+        write_shards(directory, images_file, labels_file, prefix, num_shards)
 
-    def decode_image(image):
-        # Normalize from [0, 255] to [0.0, 1.0]
-        image = tf.decode_raw(image, tf.uint8)
-        image = tf.cast(image, tf.float32)
-        image = tf.reshape(image, [784])
-        return image / 255.0
+    def parse_examples(serialized):
+        # Parse a whole batch of records with a single vectorized op
+        features = tf.parse_example(serialized, features={
+            'image': tf.FixedLenFeature([], tf.string),
+            'label': tf.FixedLenFeature([], tf.int64)})
+        images = tf.decode_raw(features['image'], tf.uint8)
+        images = tf.reshape(images, [-1, 784])
+        return images, tf.cast(features['label'], tf.uint8)
 
-    def decode_label(label):
-        label = tf.decode_raw(label, tf.uint8)  
-        label = tf.reshape(label, [])  
-        return tf.to_int32(label)
+    dataset = tf.data.Dataset.from_tensor_slices(filenames)
+    dataset = dataset.interleave(tf.data.TFRecordDataset,
+                                 cycle_length=num_shards,
+                                 num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.batch(PARSE_BATCH_SIZE).map(parse_examples,
+                                                  num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    # Downstream input functions shuffle and batch single examples
+    return dataset.apply(tf.data.experimental.unbatch())
 
-    images = tf.data.FixedLengthRecordDataset(images_file, 28 * 28, header_bytes=16)
-    images = images.map(decode_image)
-    labels = tf.data.FixedLengthRecordDataset(labels_file, 1, header_bytes=8).map(decode_label)
-    return tf.data.Dataset.zip((images, labels))
 
+def train(directory, sharded=False):
+    """tf.data.Dataset object for FMNIST training data.
 
-def train(directory):
-    """tf.data.Dataset object for FMNIST training data."""
+    If `sharded` is True, the data is read from TFRecord shards instead of being loaded in memory.
+    """
+    if sharded:
+        return sharded_dataset(directory, 'train-images-idx3-ubyte', 'train-labels-idx1-ubyte',
+                               'fmnist-train')
     return dataset(directory, 'train-images-idx3-ubyte',
                    'train-labels-idx1-ubyte')
 
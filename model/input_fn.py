@@ -11,12 +11,17 @@ def train_input_fn(data_dir, params):
         data_dir: (string) path to the data directory
         params: (Params) contains hyperparameters of the model (ex: `params.num_epochs`)
     """
-    dataset = fmnist_dataset.train(data_dir)
+    sharded = params.dict.get('use_tfrecord_shards', False)
+    dataset = fmnist_dataset.train(data_dir, sharded=sharded)
     dataset = dataset.shuffle(params.train_size)  # whole dataset into the buffer
     dataset = dataset.repeat(params.num_epochs)  # repeat for multiple epochs
     dataset = dataset.batch(params.batch_size)
-    dataset = dataset.prefetch(1)  # make sure you always have one batch ready to serve
-    return dataset
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)  # overlap input with training
+
+    # The order of examples does not matter for training, let tf.data trade it for throughput
+    options = tf.data.Options()
+    options.experimental_deterministic = False
+    return dataset.with_options(options)
 
 
 def test_input_fn(data_dir, params):
@@ -29,7 +34,7 @@ def test_input_fn(data_dir, params):
     """
     dataset = fmnist_dataset.test(data_dir)
     dataset = dataset.batch(params.batch_size)
-    dataset = dataset.prefetch(1)  # make sure you always have one batch ready to serve
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)  # overlap input with evaluation
     return dataset
 
 
@@ -37,7 +42,7 @@ def test_input_fn(data_dir, params):
 def serving_input_receiver_fn():
 
 
-  image = tf.placeholder(tf.float32, [None, 28, 28])
+  image = tf.placeholder(tf.uint8, [None, 28, 28])
   input_fn = tf.estimator.export.build_raw_serving_input_receiver_fn({'image': image,})
 
   return input_fn
@@ -6,6 +6,10 @@ from model.triplet_loss import batch_all_triplet_loss
 from model.triplet_loss import batch_hard_triplet_loss
 from model.triplet_loss import semi_hard_triplet_loss
 
+# Multiplier that normalizes uint8 pixels to [0.0, 1.0], a multiply is cheaper than a division.
+# Kept as a python float: a tf.constant created at import would belong to the import-time graph.
+PIXEL_SCALE = 1.0 / 255.0
+
 
 def build_lenet_(is_training, images, params):
     """
@@ -17,11 +21,17 @@ def build_lenet_(is_training, images, params):
     channels = [num_channels, num_channels * 2]
 
     # Convolution Layer 1
+    # The bias is redundant with the offset of batch normalization
     conv1 = tf.layers.conv2d(inputs=images,
-                             filters=params.num_channels,
+                             filters=channels[0],
                              kernel_size=[5, 5],
                              padding="same",
-                             activation=tf.nn.relu)
+                             use_bias=not params.use_batch_norm,
+                             activation=None)
+    if params.use_batch_norm:
+        conv1 = tf.layers.batch_normalization(conv1, momentum=bn_momentum, fused=True,
+                                              training=is_training)
+    conv1 = tf.nn.relu(conv1)
 
     # Pooling Layer 1
     pool1 = tf.layers.max_pooling2d(inputs=conv1, 
@@ -30,39 +40,26 @@ def build_lenet_(is_training, images, params):
 
     # Convolution Layer 2
     conv2 = tf.layers.conv2d(inputs=pool1,
-                             filters=64,
+                             filters=channels[1],
                              kernel_size=[5, 5],
                              padding="same",
-                             activation=tf.nn.relu)
-
+                             use_bias=not params.use_batch_norm,
+                             activation=None)
     if params.use_batch_norm:
-        bn = tf.layers.batch_normalization(conv2, momentum=bn_momentum, training=is_training)
-
-        # Pooling Layer 2
-        pool2 = tf.layers.max_pooling2d(inputs=bn,
-                                        pool_size=[2, 2],
-                                        strides=2)
-
-        # Dense Layer
-        pool2_flat = tf.reshape(pool2, [-1, 7 * 7 * num_channels * 2])
-        dense = tf.layers.dense(inputs=pool2_flat,
-                                units=1024,
-                                activation=tf.nn.relu)
-        out = dense
-
-    else: 
-
-        # Pooling Layer 2
-        pool2 = tf.layers.max_pooling2d(inputs=conv2,
-                                        pool_size=[2, 2],
-                                        strides=2)
-
-        # Dense Layer
-        pool2_flat = tf.reshape(pool2, [-1, 7 * 7 * 64])
-        dense = tf.layers.dense(inputs=pool2_flat,
-                                units=params.num_channels*2,
-                                activation=tf.nn.relu)
-        out = dense
+        conv2 = tf.layers.batch_normalization(conv2, momentum=bn_momentum, fused=True,
+                                              training=is_training)
+    conv2 = tf.nn.relu(conv2)
+
+    # Pooling Layer 2
+    pool2 = tf.layers.max_pooling2d(inputs=conv2,
+                                    pool_size=[2, 2],
+                                    strides=2)
+
+    # Dense Layer
+    pool2_flat = tf.reshape(pool2, [-1, 7 * 7 * channels[1]])
+    out = tf.layers.dense(inputs=pool2_flat,
+                          units=channels[1],
+                          activation=tf.nn.relu)
 
     return out
 
@@ -88,9 +85,10 @@ def basic_model(is_training, images, params):
     channels = [num_channels, num_channels * 2]
     for i, c in enumerate(channels):
         with tf.variable_scope('block_{}'.format(i+1)):
-            out = tf.layers.conv2d(out, c, 3, padding='same')
+            out = tf.layers.conv2d(out, c, 3, padding='same', use_bias=not params.use_batch_norm)
             if params.use_batch_norm:
-                out = tf.layers.batch_normalization(out, momentum=bn_momentum, training=is_training)
+                out = tf.layers.batch_normalization(out, momentum=bn_momentum, fused=True,
+                                                    training=is_training)
             out = tf.nn.relu(out)
             out = tf.layers.max_pooling2d(out, 2, 2)
 
@@ -103,6 +101,39 @@ def basic_model(is_training, images, params):
     return out
 
 
+def float32_variable_storage_getter(getter, name, shape=None, dtype=None, *args, **kwargs):
+    """Custom variable getter that stores float16 variables in float32.
+
+    Layers fed with float16 inputs get a float16 cast of a float32 variable, so that the
+    optimizer updates the float32 copy and small updates are not lost to rounding.
+    """
+    storage_dtype = tf.float32 if dtype == tf.float16 else dtype
+    variable = getter(name, shape, dtype=storage_dtype, *args, **kwargs)
+    if dtype == tf.float16:
+        variable = tf.cast(variable, tf.float16)
+    return variable
+
+
+def quantize_embeddings(embeddings):
+    """Quantize embeddings to int8 with a symmetric scale per embedding.
+
+    The embeddings are approximately `tf.cast(embeddings_q, tf.float32) * scale[:, None]`.
+    A scale per embedding (rather than per batch) keeps predictions independent of batching.
+
+    Args:
+        embeddings: tensor of shape (batch_size, embed_dim)
+
+    Returns:
+        embeddings_q: tf.int8 tensor of shape (batch_size, embed_dim)
+        scale: tf.float32 tensor of shape (batch_size,)
+    """
+    scale = tf.reduce_max(tf.abs(embeddings), axis=1) / 127.0
+    # Avoid dividing by zero for an all-zero embedding
+    scale = tf.maximum(scale, 1e-12)
+    embeddings_q = tf.cast(tf.round(embeddings / tf.expand_dims(scale, 1)), tf.int8)
+    return embeddings_q, scale
+
+
 def model_fn(features, labels, mode, params):
     """Model function for tf.estimator
 
@@ -118,24 +149,48 @@ def model_fn(features, labels, mode, params):
 
     is_training = (mode == tf.estimator.ModeKeys.TRAIN)
 
-    images = features
-    images = tf.reshape(images, [-1, params.image_size, params.image_size, 1])
-    assert images.shape[1:] == [params.image_size, params.image_size, 1], "{}".format(images.shape)
+    # Images arrive as uint8 so that only 1 byte per pixel is copied to the device. The reshape
+    # and the cast are left to the default placement, which puts them on the GPU when there is one.
+    with tf.name_scope('preprocessing'):
+        images = features
+        images = tf.reshape(images, [-1, params.image_size, params.image_size, 1])
+        assert images.shape[1:] == [params.image_size, params.image_size, 1], "{}".format(images.shape)
+        assert images.dtype == tf.uint8, "{}".format(images.dtype)
+
+        # Normalize from [0, 255] to [0.0, 1.0]
+        images = tf.cast(images, tf.float32) * PIXEL_SCALE
 
     # -----------------------------------------------------------
 
-    with tf.variable_scope('model'):
+    # With mixed precision the embedding network runs in float16, while its weights are stored
+    # and updated in float32
+    use_mixed_precision = params.dict.get('use_mixed_precision', False)
+    compute_dtype = tf.float16 if use_mixed_precision else tf.float32
+    custom_getter = float32_variable_storage_getter if use_mixed_precision else None
+
+    # Compile the embedding network with XLA so that the pooling, flatten and dense layers are
+    # fused instead of each writing its activations back to memory
+    with tf.variable_scope('model', custom_getter=custom_getter), \
+            tf.contrib.compiler.jit.experimental_jit_scope():
         # Compute the embeddings with the model
 
-        embeddings = build_lenet_(is_training, images, params)
+        embeddings = build_lenet_(is_training, tf.cast(images, compute_dtype), params)
 
-    embedding_mean_norm = tf.reduce_mean(tf.norm(embeddings, axis=1))
-    tf.summary.scalar("embedding_mean_norm", embedding_mean_norm)
+    # The pairwise distances of the triplet loss cancel large terms, keep them in float32
+    embeddings = tf.cast(embeddings, tf.float32)
 
     if mode == tf.estimator.ModeKeys.PREDICT:
-        predictions = {'embeddings': embeddings}
+        embeddings_q, scale = quantize_embeddings(embeddings)
+        predictions = {'embeddings': embeddings,
+                       'embeddings_q': embeddings_q,
+                       'scale': scale}
         return tf.estimator.EstimatorSpec(mode=mode, predictions=predictions)
 
+    # Only evaluated when the summaries are saved (every `save_summary_steps`) or by the metrics
+    embedding_mean_norm = tf.reduce_mean(tf.norm(embeddings, axis=1))
+    tf.summary.scalar("embedding_mean_norm", embedding_mean_norm)
+
+    # Labels arrive as uint8 from the input pipeline
     labels = tf.cast(labels, tf.int64)
 
     # Define triplet loss
@@ -178,6 +233,9 @@ def model_fn(features, labels, mode, params):
 
     # Define training step that minimizes the loss with the Adam optimizer
     optimizer = tf.train.AdamOptimizer(params.learning_rate)
+    if use_mixed_precision:
+        # Dynamic loss scaling keeps the float16 gradients of the network from underflowing
+        optimizer = tf.train.experimental.MixedPrecisionLossScaleOptimizer(optimizer, 'dynamic')
     global_step = tf.train.get_global_step()
 
     if params.use_batch_norm:
@@ -9,6 +9,7 @@ from model.input_fn import test_input_fn
 from model.input_fn import serving_input_receiver_fn
 from model.model_fn import model_fn
 from model.utils import Params
+from model.utils import get_session_config
 
 
 parser = argparse.ArgumentParser()
@@ -16,6 +17,8 @@ parser.add_argument('--model_dir', default='experiments/base_model',
                     help="Experiment directory containing params.json")
 parser.add_argument('--data_dir', default='data/fmnist',
                     help="Directory containing the dataset")
+parser.add_argument('--num_gpus', default=1, type=int,
+                    help="Number of GPUs to replicate training on")
 parser.add_argument('--model_save', default='/Users/aarti/Documents/triplet_loss_/tensorflow-triplet-loss/experiments/pb')
 
 
@@ -23,6 +26,8 @@ if __name__ == '__main__':
 
     tf.reset_default_graph()
     tf.logging.set_verbosity(tf.logging.INFO)
+    # Resource variables let the optimizer use the single-kernel ResourceApplyAdam update
+    tf.enable_resource_variables()
 
     # Load the parameters from json file
     args = parser.parse_args()
@@ -32,9 +37,17 @@ if __name__ == '__main__':
 
     # Define the model
     tf.logging.info("Creating the model...")
+    strategy = None
+    if args.num_gpus > 1:
+        # Data parallel training: every replica gets its own batch of `params.batch_size`
+        # examples from the input function, gradients are averaged across replicas
+        devices = ['/gpu:{}'.format(i) for i in range(args.num_gpus)]
+        strategy = tf.distribute.MirroredStrategy(devices=devices)
     config = tf.estimator.RunConfig(tf_random_seed=230,
                                     model_dir=args.model_dir,
-                                    save_summary_steps=params.save_summary_steps)
+                                    save_summary_steps=params.save_summary_steps,
+                                    session_config=get_session_config(),
+                                    train_distribute=strategy)
     estimator = tf.estimator.Estimator(model_fn, params=params, config=config)
 
     # Train the model
@@ -11,6 +11,7 @@ from tensorflow.contrib.tensorboard.plugins import projector
 
 import model.fmnist_dataset as fmnist_dataset
 from model.utils import Params
+from model.utils import get_session_config
 from model.input_fn import test_input_fn
 from model.model_fn import model_fn
 
@@ -42,7 +43,8 @@ if __name__ == '__main__':
     tf.logging.info("Creating the model...")
     config = tf.estimator.RunConfig(tf_random_seed=230,
                                     model_dir=args.model_dir,
-                                    save_summary_steps=params.save_summary_steps)
+                                    save_summary_steps=params.save_summary_steps,
+                                    session_config=get_session_config())
     estimator = tf.estimator.Estimator(model_fn, params=params, config=config)
 
 